@@ -28,6 +28,26 @@ __author__ = ('tav@espians.com (tav),'
 __maintainer__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
 
 import csv
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+import hashlib
+import httplib
+import multiprocessing
+import os
+import Queue
+import select
+import socket
+import ssl
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 try:
     from cStringIO import StringIO
@@ -35,7 +55,8 @@ except ImportError:
     from StringIO import StringIO
 
 from urllib import quote, urlencode
-from urllib2 import urlopen
+from urllib2 import HTTPError, Request, URLError, urlopen
+from urlparse import urlsplit
 
 try:
     from xml.etree import cElementTree as ElementTree
@@ -50,6 +71,21 @@ except ImportError:
 
 from yaml import dump
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.windows
+except ImportError:
+    h2 = None
+
 
 DEFAULT_CONTACT_FIELDS = ('first name', 'last_name', 'email', 'tags')
 
@@ -65,6 +101,106 @@ def parse_lists(response):
     return lists
 
 
+def encode_contacts(contacts_data, fields=DEFAULT_CONTACT_FIELDS):
+    """Encode contact data as CSV with fields as the header row."""
+    contacts = []
+    contacts.append((fields))
+    contacts.extend(contacts_data)
+
+    csvdata = StringIO()
+    writer = csv.writer(csvdata)
+    [writer.writerow(row) for row in contacts]
+
+    return csvdata.getvalue()
+
+
+def encode_body(body):
+    """Serialize a dict of template variables as YAML."""
+    # The YAML dump will fail if it encounters non-strings
+    for item, value in body.iteritems():
+        body[item] = str(value)
+
+    return dump(body)
+
+
+def _encode_contacts_job(job):
+    return encode_contacts(*job)
+
+
+class EncoderPool(object):
+    """A process pool for the CPU heavy encoding and parsing work.
+
+    Requests are cheap to issue from threads, but encoding contacts, message
+    bodies and list responses holds the GIL. The pool spreads that work over
+    all cores while the requests stay in the calling process:
+
+      >>> pool = EncoderPool()
+      >>> for csv_data in pool.encode_contacts(chunks, fields):
+      ...     mimi.add_contacts_csv(csv_data)
+      >>> pool.close()
+
+    Every method returns an iterator over the results in input order.
+    """
+    def __init__(self, processes=None, chunksize=1):
+        self.chunksize = chunksize
+        self._pool = multiprocessing.Pool(processes)
+
+    def encode_contacts(self, chunks, fields=DEFAULT_CONTACT_FIELDS):
+        """Encode chunks of contact data as CSV for add_contacts_csv."""
+        return self._pool.imap(_encode_contacts_job,
+                               ((chunk, fields) for chunk in chunks),
+                               self.chunksize)
+
+    def encode_bodies(self, bodies):
+        """Serialize message bodies for send_message and
+        send_message_to_list."""
+        return self._pool.imap(encode_body, bodies, self.chunksize)
+
+    def parse_lists(self, responses):
+        """Parse raw list responses into dictionaries of MailingLists."""
+        return self._pool.imap(parse_lists, responses, self.chunksize)
+
+    def close(self):
+        """Wait for outstanding work and shut the worker processes down."""
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """Stop the worker processes immediately."""
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# The per-promotion counters read from promotions.xml. Each may be given as
+# an attribute or a child element of <promotion>; missing ones count as 0.
+PROMOTION_COUNTERS = ('sends', 'opens', 'clicks', 'bounces', 'unsubscribes',
+                      'forwards')
+
+def parse_promotion_stats(response):
+    tree = ElementTree.ElementTree()
+    promotions = {}
+    tree.parse(StringIO(response))
+    for elem in list(tree.getiterator('promotion')):
+        counters = {}
+        for counter in PROMOTION_COUNTERS:
+            value = elem.attrib.get(counter)
+            if value is None:
+                value = elem.findtext(counter)
+            counters[counter] = int(value or 0)
+        promotion_id = int(elem.attrib['id'])
+        promotions[promotion_id] = PromotionStats(promotion_id,
+                                                  elem.attrib.get('name', ''),
+                                                  **counters)
+
+    return promotions
+
+
 class MailingList(object):
     """The main mailing list object."""
     def __init__(self, list_id=0, list_name="", subscribers=0):
@@ -79,6 +215,1051 @@ class MailingList(object):
         return "<MailingList: %s>" % self.name
 
 
+class PromotionStats(object):
+    """Counters for a single promotion."""
+    def __init__(self, promotion_id=0, promotion_name="", **counters):
+        self.id = promotion_id
+        self.name = promotion_name
+        for counter in PROMOTION_COUNTERS:
+            setattr(self, counter, counters.get(counter, 0))
+
+    def counters(self):
+        """Return the counters as a tuple in PROMOTION_COUNTERS order."""
+        return tuple(getattr(self, counter) for counter in PROMOTION_COUNTERS)
+
+    def __unicode__(self):
+        return u"<PromotionStats: %s>" % self.name
+
+    def __repr__(self):
+        return "<PromotionStats: %s>" % self.name
+
+
+class PromotionStatsStore(object):
+    """An append-only, columnar time series of promotion stats.
+
+    The store is a directory holding one file per column: 'time' (seconds
+    since the epoch, as doubles), 'promotion' (the promotion id) and one per
+    counter in PROMOTION_COUNTERS (unsigned 32 bit integers). All are raw
+    native-endian arrays, so they can be memory-mapped as they are. A row is
+    only appended when a promotion's counters differ from its last row, so
+    a polling collector stores changes rather than whole snapshots.
+
+    Every promotion id and its name are kept alongside in 'names.csv'.
+    """
+    # Rows read at a time when scanning back from the end of the columns.
+    block_size = 65536
+
+    columns = (('time', 'd'), ('promotion', 'I')) + tuple(
+            (counter, 'I') for counter in PROMOTION_COUNTERS)
+
+    def __init__(self, path):
+        self.path = path
+        self.names = {}
+        self._latest = {}
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # A crash part way through an append can leave some columns a row
+        # longer than others. Drop any such partial row.
+        sizes = []
+        for name, typecode in self.columns:
+            column_path = self._column_path(name)
+            if not os.path.exists(column_path):
+                open(column_path, 'wb').close()
+            sizes.append(os.path.getsize(column_path) //
+                         array(typecode).itemsize)
+        self.length = min(sizes)
+        for name, typecode in self.columns:
+            column_path = self._column_path(name)
+            if os.path.getsize(column_path) > (self.length *
+                                               array(typecode).itemsize):
+                column = open(column_path, 'r+b')
+                try:
+                    column.truncate(self.length * array(typecode).itemsize)
+                finally:
+                    column.close()
+
+        names_path = os.path.join(path, 'names.csv')
+        if os.path.exists(names_path):
+            names = open(names_path, 'rb')
+            try:
+                for promotion_id, promotion_name in csv.reader(names):
+                    self.names[int(promotion_id)] = promotion_name
+            finally:
+                names.close()
+
+        # Find each promotion's last row, scanning back from the end until
+        # every promotion has been seen.
+        last_rows = {}
+        hi = self.length
+        while hi > 0 and len(last_rows) < len(self.names):
+            lo = max(hi - self.block_size, 0)
+            promotions = self._block('promotion', lo, hi)
+            if numpy is not None:
+                ids, offsets = numpy.unique(promotions[::-1],
+                                            return_index=True)
+                found = zip(ids.tolist(), (hi - 1 - offsets).tolist())
+            else:
+                found = ((promotions[i - lo], i)
+                         for i in xrange(hi - 1, lo - 1, -1))
+            for promotion_id, row in found:
+                last_rows.setdefault(int(promotion_id), row)
+            hi = lo
+        for promotion_id, row in last_rows.iteritems():
+            self._latest[promotion_id] = tuple(
+                    int(self._block(counter, row, row + 1)[0])
+                    for counter in PROMOTION_COUNTERS)
+
+        self.last_time = 0
+        if self.length:
+            self.last_time = float(
+                    self._block('time', self.length - 1, self.length)[0])
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name)
+
+    def column(self, name):
+        """Return a whole column.
+
+        With NumPy installed this is a read-only memory-mapped array,
+        otherwise the column is read into an array.array.
+        """
+        typecode = dict(self.columns)[name]
+        if numpy is not None:
+            if not self.length:
+                return numpy.zeros(0, dtype=typecode)
+            return numpy.memmap(self._column_path(name), dtype=typecode,
+                                mode='r', shape=(self.length,))
+
+        values = array(typecode)
+        column = open(self._column_path(name), 'rb')
+        try:
+            values.fromfile(column, self.length)
+        finally:
+            column.close()
+        return values
+
+    def _block(self, name, lo, hi):
+        """Return rows lo to hi of a column, without reading the rest."""
+        if numpy is not None:
+            return self.column(name)[lo:hi]
+
+        typecode = dict(self.columns)[name]
+        values = array(typecode)
+        column = open(self._column_path(name), 'rb')
+        try:
+            column.seek(lo * values.itemsize)
+            values.fromfile(column, hi - lo)
+        finally:
+            column.close()
+        return values
+
+    def append(self, stats, timestamp=None):
+        """Record a snapshot of promotion stats.
+
+        Arguments:
+            stats: A dictionary of PromotionStats, as returned by
+                parse_promotion_stats.
+            timestamp: When the snapshot was taken, in seconds since the
+                epoch. Defaults to now. (Optional)
+
+        Returns:
+            The number of promotions whose counters changed.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if timestamp < self.last_time:
+            raise ValueError('timestamp %s is before the last snapshot'
+                             % timestamp)
+
+        rows = []
+        new_names = []
+        for promotion_id in sorted(stats):
+            promotion = stats[promotion_id]
+            counters = promotion.counters()
+            if self._latest.get(promotion_id) != counters:
+                rows.append((timestamp, promotion_id) + counters)
+                self._latest[promotion_id] = counters
+            # Every id is recorded, even without a name, so that opening
+            # the store knows which promotions to look for.
+            if promotion_id not in self.names or (promotion.name and
+                    self.names[promotion_id] != promotion.name):
+                new_names.append((promotion_id, promotion.name))
+                self.names[promotion_id] = promotion.name
+
+        if new_names:
+            names = open(os.path.join(self.path, 'names.csv'), 'ab')
+            try:
+                csv.writer(names).writerows(new_names)
+            finally:
+                names.close()
+
+        if rows:
+            for i, (name, typecode) in enumerate(self.columns):
+                column = open(self._column_path(name), 'ab')
+                try:
+                    array(typecode, [row[i] for row in rows]).tofile(column)
+                finally:
+                    column.close()
+            self.length += len(rows)
+        self.last_time = timestamp
+
+        return len(rows)
+
+    def collect(self, mimi, timestamp=None):
+        """Fetch the current promotion stats from Mad Mimi and record them."""
+        return self.append(parse_promotion_stats(mimi.promotion_stats()),
+                           timestamp)
+
+    def _bounds(self, start=None, end=None):
+        """Return the range of rows recorded between start and end."""
+        times = self.column('time')
+        lo = 0
+        hi = self.length
+        if numpy is not None:
+            if start is not None:
+                lo = int(numpy.searchsorted(times, start, 'left'))
+            if end is not None:
+                hi = int(numpy.searchsorted(times, end, 'right'))
+        else:
+            if start is not None:
+                lo = bisect_left(times, start)
+            if end is not None:
+                hi = bisect_right(times, end)
+        return lo, hi
+
+    def _last_row(self, promotion_id, end):
+        """Return the last row for a promotion at or before end, or None."""
+        hi = self._bounds(end=end)[1]
+        while hi > 0:
+            lo = max(hi - self.block_size, 0)
+            promotions = self._block('promotion', lo, hi)
+            if numpy is not None:
+                rows = numpy.flatnonzero(promotions == promotion_id)
+                if len(rows):
+                    return lo + int(rows[-1])
+            else:
+                for i in xrange(hi - lo - 1, -1, -1):
+                    if promotions[i] == promotion_id:
+                        return lo + i
+            hi = lo
+        return None
+
+    def series(self, promotion_id, start=None, end=None,
+               counters=PROMOTION_COUNTERS):
+        """Get the recorded values of a promotion's counters.
+
+        Arguments:
+            promotion_id: The id of the promotion.
+            start: Only include rows recorded at or after this time, in
+                seconds since the epoch. (Optional)
+            end: Only include rows recorded at or before this time.
+                (Optional)
+            counters: The counters to include. Defaults to all of them.
+                (Optional)
+
+        Returns:
+            A dictionary of lists, keyed by 'time' and the counter names.
+            {'time': [1300000000.0, ...], 'sends': [120, ...], ...}
+        """
+        lo, hi = self._bounds(start, end)
+        promotions = self._block('promotion', lo, hi)
+        if numpy is not None:
+            rows = numpy.flatnonzero(promotions == promotion_id)
+        else:
+            rows = [i for i, value in enumerate(promotions)
+                    if value == promotion_id]
+
+        result = {}
+        for name in ('time',) + tuple(counters):
+            column = self._block(name, lo, hi)
+            if numpy is not None:
+                result[name] = column[rows].tolist()
+            else:
+                result[name] = [column[i] for i in rows]
+            if name == 'time':
+                result[name] = [float(value) for value in result[name]]
+            else:
+                result[name] = [int(value) for value in result[name]]
+
+        return result
+
+    def value_at(self, promotion_id, timestamp):
+        """Get a promotion's counters as of a point in time.
+
+        Returns:
+            A dictionary of counter values, or None if nothing was recorded
+            for the promotion at or before timestamp.
+        """
+        row = self._last_row(promotion_id, timestamp)
+        if row is None:
+            return None
+
+        return dict((counter, int(self._block(counter, row, row + 1)[0]))
+                    for counter in PROMOTION_COUNTERS)
+
+    def change(self, promotion_id, start, end=None):
+        """Get how much a promotion's counters grew between two times.
+
+        For example the sends, opens and clicks of the last 7 days:
+
+          >>> store.change(1234, time.time() - 7 * 86400)
+          {'sends': 1200, 'opens': 431, 'clicks': 57, ...}
+        """
+        if end is None:
+            end = self.last_time
+        before = self.value_at(promotion_id, start)
+        after = self.value_at(promotion_id, end)
+        if after is None:
+            return dict((counter, 0) for counter in PROMOTION_COUNTERS)
+        if before is None:
+            return after
+
+        return dict((counter, after[counter] - before[counter])
+                    for counter in PROMOTION_COUNTERS)
+
+
+def replace_file(src, dst):
+    """Move src over dst, replacing any existing file."""
+    # os.rename won't replace an existing file on Windows.
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def contact_digest(row):
+    """Return a stable content hash for a row of contact data."""
+    csvdata = StringIO()
+    csv.writer(csvdata).writerow(row)
+
+    return hashlib.sha1(csvdata.getvalue()).hexdigest()
+
+
+class AudienceSnapshot(object):
+    """A local record of the audience state last pushed to Mad Mimi.
+
+    The snapshot is kept as a tab separated file with one line per contact:
+    the email address, the content hash of the contact row and the names of
+    the audience lists the contact belongs to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.contacts = {}
+        self.memberships = {}
+
+        if os.path.exists(path):
+            snapshot = open(path, 'rb')
+            try:
+                for row in csv.reader(snapshot, dialect='excel-tab'):
+                    self.contacts[row[0]] = row[1]
+                    self.memberships[row[0]] = frozenset(row[2:])
+            finally:
+                snapshot.close()
+
+    def save(self):
+        """Write the snapshot to disk, replacing the previous one."""
+        tmp_path = self.path + '.tmp'
+        snapshot = open(tmp_path, 'wb')
+        try:
+            writer = csv.writer(snapshot, dialect='excel-tab')
+            for email, digest in sorted(self.contacts.iteritems()):
+                row = [email, digest]
+                row.extend(sorted(self.memberships.get(email, ())))
+                writer.writerow(row)
+        finally:
+            snapshot.close()
+
+        replace_file(tmp_path, self.path)
+
+
+def _body_chunks(body, blocksize=16384):
+    """Iterate over a request body given as a string, file or iterable."""
+    if isinstance(body, basestring):
+        yield body
+    elif hasattr(body, 'read'):
+        while True:
+            chunk = body.read(blocksize)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in body:
+            yield chunk
+
+
+class Transport(object):
+    """Base class for the HTTP transports used by MadMimi.
+
+    A transport issues requests and returns file-like responses with read(),
+    getcode(), info() and geturl(), like urllib2.urlopen does. Error
+    responses raise urllib2.HTTPError.
+
+    Configuration lives in public attributes. Connections, locks and other
+    per-process state live in private attributes set up by reset(), which
+    is called again after a fork and when a pickled transport is loaded.
+    """
+    def __init__(self):
+        self.reset()
+
+    def __getstate__(self):
+        return dict((name, value) for name, value in self.__dict__.iteritems()
+                    if not name.startswith('_'))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
+    def request(self, method, url, body=None, headers=None):
+        """Issue an HTTP request.
+
+        Arguments:
+            method: The HTTP method, e.g. 'GET' or 'POST'.
+            url: The absolute URL to request.
+            body: The request body as a string, a file-like object or an
+                iterable of strings. Files and iterables are streamed where
+                the transport supports it. (Optional)
+            headers: A dictionary of extra request headers. (Optional)
+
+        Returns:
+            A file-like response. The body is read from the network as it is
+            consumed.
+        """
+        raise NotImplementedError
+
+    def urlopen(self, url, data=None):
+        """Open url like urllib2.urlopen: POST data if given, else GET."""
+        if data is None:
+            return self.request('GET', url)
+        return self.request('POST', url, data,
+                {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def reset(self):
+        """Forget any open connections without closing them.
+
+        Used in a forked child, where closing a connection shared with the
+        parent would break it for the parent too.
+        """
+
+    def close(self):
+        """Close any open connections."""
+
+
+class UrllibTransport(Transport):
+    """Transport using urllib2, with a new connection for every request."""
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        Transport.__init__(self)
+
+    def _urlopen(self, *args):
+        if self.timeout is None:
+            return urlopen(*args)
+        return urlopen(*args, **{'timeout': self.timeout})
+
+    def request(self, method, url, body=None, headers=None):
+        if body is not None and not isinstance(body, basestring):
+            body = ''.join(_body_chunks(body))
+        request = Request(url, body, headers or {})
+        request.get_method = lambda: method
+        return self._urlopen(request)
+
+    def urlopen(self, url, data=None):
+        if data is None:
+            return self._urlopen(url)
+        return self._urlopen(url, data)
+
+
+class _PooledResponse(object):
+    """A response that hands its connection back to the pool once read."""
+    def __init__(self, response, url, release):
+        self._response = response
+        self._release = release
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._done(True)
+        return data
+
+    def close(self):
+        self._done(self._response.isclosed())
+
+    def _done(self, reusable):
+        if self._release is not None:
+            self._release(reusable)
+            self._release = None
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self.url
+
+
+# Methods that may be sent again when a connection drops before the response.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class PooledTransport(Transport):
+    """Transport keeping HTTP/1.1 connections alive between requests.
+
+    Idle connections are pooled per host, up to maxsize each. A connection
+    goes back to the pool once its response has been read to the end, so
+    responses should be read or closed.
+
+    Bodies given as files or iterables are sent with chunked transfer
+    encoding unless a Content-Length header is given.
+    """
+    def __init__(self, maxsize=10, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        Transport.__init__(self)
+
+    def reset(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+    def _connect(self, key):
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._idle.get(key):
+                    break
+                connection = self._idle[key].pop()
+            finally:
+                self._lock.release()
+            if not self._dropped(connection):
+                return connection, True
+            connection.close()
+
+        scheme, netloc = key
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        return connection_class(netloc, timeout=self.timeout), False
+
+    def _dropped(self, connection):
+        """Check whether the server has closed an idle connection."""
+        if connection.sock is None:
+            return True
+        # An idle connection has nothing to read unless it was closed.
+        return bool(select.select([connection.sock], [], [], 0)[0])
+
+    def _release(self, key, connection, reusable):
+        if reusable:
+            self._lock.acquire()
+            try:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.maxsize:
+                    idle.append(connection)
+                    return
+            finally:
+                self._lock.release()
+        connection.close()
+
+    def _send(self, connection, method, path, body, headers):
+        if (body is None or isinstance(body, basestring)
+                or 'Content-Length' in headers):
+            connection.request(method, path, body, headers)
+            return
+
+        connection.putrequest(method, path)
+        for name, value in headers.iteritems():
+            connection.putheader(name, value)
+        connection.putheader('Transfer-Encoding', 'chunked')
+        connection.endheaders()
+        for chunk in _body_chunks(body):
+            if chunk:
+                connection.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+        connection.send('0\r\n\r\n')
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+
+        replayable = body is None or isinstance(body, basestring)
+        while True:
+            connection, reused = self._connect(key)
+            try:
+                self._send(connection, method, path, body, headers)
+            except socket.timeout:
+                connection.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # The server dropped the idle connection before the request
+                # got through, so it's safe to send it again.
+                if reused and replayable:
+                    continue
+                raise
+
+            try:
+                response = connection.getresponse()
+                break
+            except httplib.BadStatusLine, e:
+                connection.close()
+                # The server closed the connection without answering. It
+                # may still have acted on the request, so only requests
+                # that are safe to repeat are retried.
+                nothing_received = (e.line == "''" or
+                                    e.line.startswith('No status line'))
+                if (reused and replayable and nothing_received
+                        and method in IDEMPOTENT_METHODS):
+                    continue
+                raise
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise
+
+        def release(reusable):
+            self._release(key, connection,
+                          reusable and not response.will_close)
+
+        result = _PooledResponse(response, url, release)
+        if response.status >= 400:
+            # Read error bodies right away to free the connection.
+            raise HTTPError(url, response.status, response.reason,
+                            response.msg, StringIO(result.read()))
+        return result
+
+
+class _HTTP2Response(object):
+    """A response streamed from an HTTP/2 stream."""
+    def __init__(self, connection, stream_id, url):
+        self._connection = connection
+        self.stream_id = stream_id
+        self.url = url
+        self.code = None
+        self.headers = {}
+        self.ended = False
+        self.error = None
+        # When data last moved on this stream, for timeouts.
+        self.active = time.time()
+        self._chunks = deque()
+        # Flow-controlled bytes received but not yet read, which the server
+        # can't resend until we acknowledge them.
+        self._unacked = 0
+
+    def read(self, amt=None):
+        connection = self._connection
+        connection.lock.acquire()
+        try:
+            parts = []
+            size = 0
+            while amt is None or size < amt:
+                try:
+                    connection.wait(
+                            lambda: self._chunks or self.ended or self.error,
+                            self)
+                except URLError:
+                    connection._cancel(self)
+                    raise
+                if self.error is not None and not self.ended:
+                    raise self.error
+                if not self._chunks:
+                    break
+                consumed = 0
+                while self._chunks and (amt is None or size < amt):
+                    chunk = self._chunks.popleft()
+                    if amt is not None and size + len(chunk) > amt:
+                        self._chunks.appendleft(chunk[amt - size:])
+                        chunk = chunk[:amt - size]
+                    parts.append(chunk)
+                    size += len(chunk)
+                    consumed += len(chunk)
+                # Only open the window for what has been read, so a slow
+                # reader holds the server back instead of buffering. Padding
+                # is handed back once the buffer drains.
+                if not self._chunks:
+                    consumed = self._unacked
+                self._unacked -= consumed
+                connection._acknowledge(self.stream_id, consumed)
+            return ''.join(parts)
+        finally:
+            connection.lock.release()
+
+    def close(self):
+        self._connection.cancel(self)
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+
+class _HTTP2Connection(object):
+    """One HTTP/2 connection shared by any number of threads.
+
+    Every thread can have requests in flight. Whichever waiting thread gets
+    there first reads from the socket and dispatches what arrives to the
+    responses of all streams, while the others wait to be notified. The h2
+    state machine is guarded by lock; the socket itself by _io_lock.
+    """
+    def __init__(self, host, port, secure, timeout):
+        self.timeout = timeout
+        self.lock = threading.Condition()
+        self.closed = False
+        self._error = None
+        self._reading = False
+        self._streams = {}
+        self._io_lock = threading.Lock()
+
+        sock = socket.create_connection((host, port), timeout)
+        if secure:
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(['h2'])
+            sock = context.wrap_socket(sock, server_hostname=host)
+            if sock.selected_alpn_protocol() != 'h2':
+                sock.close()
+                raise URLError('%s:%s does not support HTTP/2' % (host, port))
+        self._sock = sock
+
+        self._h2 = h2.connection.H2Connection(
+                config=h2.config.H2Configuration(client_side=True))
+        self._h2.initiate_connection()
+        # Bodies are only acknowledged as they are read. Stream windows keep
+        # each response bounded; a connection window that size would let
+        # one unread response stall every other stream.
+        self._h2.increment_flow_control_window(
+                h2.windows.LARGEST_FLOW_CONTROL_WINDOW -
+                self._h2.inbound_flow_control_window)
+        self._flush()
+
+    def _flush(self):
+        data = self._h2.data_to_send()
+        if data:
+            self._io_lock.acquire()
+            try:
+                self._sock.sendall(data)
+            finally:
+                self._io_lock.release()
+
+    def _read(self):
+        """Read whatever the server has sent, or None after a timeout."""
+        pending = getattr(self._sock, 'pending', None)
+        if not (pending and pending()):
+            if not select.select([self._sock], [], [], 1.0)[0]:
+                return None
+        self._io_lock.acquire()
+        try:
+            return self._sock.recv(65535)
+        except socket.timeout:
+            return None
+        finally:
+            self._io_lock.release()
+
+    def _fail(self, error):
+        self.closed = True
+        self._error = error
+        for response in self._streams.itervalues():
+            response.error = error
+        self._streams = {}
+        self._sock.close()
+
+    def _protocol_error(self, error):
+        """Fail the connection after an HTTP/2 protocol error.
+
+        Returns the URLError the pending requests fail with. The transport
+        opens a new connection for the next request.
+        """
+        try:
+            self._flush()
+        except socket.error:
+            pass
+        self._fail(URLError(error))
+        return self._error
+
+    def _receive(self, data):
+        try:
+            events = self._h2.receive_data(data)
+        except h2.exceptions.ProtocolError, e:
+            # Typically frames that arrive after the server's GOAWAY.
+            self._protocol_error(e)
+            return
+
+        terminated = None
+        for event in events:
+            if isinstance(event, h2.events.ConnectionTerminated):
+                # Streams the server did process may still complete in this
+                # batch, so finish it before failing the rest.
+                terminated = event
+                continue
+            # Streams we've cancelled may still see frames in flight.
+            response = self._streams.get(getattr(event, 'stream_id', None))
+            if response is None:
+                if isinstance(event, h2.events.DataReceived):
+                    self._h2.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id)
+                continue
+            response.active = time.time()
+            if isinstance(event, h2.events.ResponseReceived):
+                response.headers = dict(event.headers)
+                response.code = int(response.headers[':status'])
+            elif isinstance(event, h2.events.DataReceived):
+                response._chunks.append(event.data)
+                response._unacked += event.flow_controlled_length
+            elif isinstance(event, h2.events.StreamEnded):
+                response.ended = True
+                del self._streams[event.stream_id]
+            elif isinstance(event, h2.events.StreamReset):
+                response.error = URLError('stream reset by server (%s)'
+                                          % event.error_code)
+                del self._streams[event.stream_id]
+        try:
+            self._flush()
+        except socket.error, e:
+            self._fail(URLError(e))
+            return
+
+        if terminated is not None:
+            self._fail(URLError('connection closed by server (%s)'
+                                % terminated.error_code))
+
+    def wait(self, predicate, response=None):
+        """Block until predicate() is true. Must be called holding lock.
+
+        Times out when nothing has moved on response's stream for timeout
+        seconds, or after timeout seconds without a response. Traffic on
+        other streams doesn't count.
+        """
+        started = time.time()
+        while not predicate():
+            if self.closed:
+                raise self._error
+            active = started
+            if response is not None:
+                active = max(started, response.active)
+            if time.time() > active + self.timeout:
+                raise URLError('timed out')
+            if self._reading:
+                self.lock.wait(1.0)
+                continue
+
+            self._reading = True
+            self.lock.release()
+            try:
+                try:
+                    data = self._read()
+                except (socket.error, select.error), e:
+                    data = e
+            finally:
+                self.lock.acquire()
+                self._reading = False
+                self.lock.notify_all()
+
+            if isinstance(data, Exception):
+                self._fail(URLError(data))
+            elif data == '':
+                self._fail(URLError('connection closed by server'))
+            elif data is not None:
+                self._receive(data)
+
+    def request(self, method, scheme, authority, path, url, body, headers):
+        self.lock.acquire()
+        try:
+            self.wait(lambda: self._h2.open_outbound_streams <
+                      self._h2.remote_settings.max_concurrent_streams)
+            try:
+                stream_id = self._h2.get_next_available_stream_id()
+            except h2.exceptions.ProtocolError, e:
+                raise self._protocol_error(e)
+            response = _HTTP2Response(self, stream_id, url)
+            self._streams[stream_id] = response
+            try:
+                self._send_request(response, method, scheme, authority,
+                                   path, body, headers)
+            except h2.exceptions.ProtocolError, e:
+                raise self._protocol_error(e)
+            except Exception:
+                # Free the stream so it doesn't hold a concurrency slot.
+                exc_info = sys.exc_info()
+                self._cancel(response)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return response
+        finally:
+            self.lock.release()
+
+    def _send_request(self, response, method, scheme, authority, path, body,
+                      headers):
+        stream_id = response.stream_id
+        request_headers = [(':method', method), (':scheme', scheme),
+                           (':authority', authority), (':path', path)]
+        request_headers.extend((name.lower(), value)
+                               for name, value in headers.iteritems())
+        self._h2.send_headers(stream_id, request_headers,
+                              end_stream=body is None)
+        self._flush()
+
+        if body is not None:
+            for chunk in _body_chunks(body):
+                while chunk:
+                    self.wait(lambda: response.error or
+                              self._h2.local_flow_control_window(stream_id),
+                              response)
+                    if response.error is not None:
+                        raise response.error
+                    size = min(len(chunk),
+                               self._h2.local_flow_control_window(stream_id),
+                               self._h2.max_outbound_frame_size)
+                    self._h2.send_data(stream_id, chunk[:size])
+                    self._flush()
+                    response.active = time.time()
+                    chunk = chunk[size:]
+            self._h2.end_stream(stream_id)
+            self._flush()
+
+        self.wait(lambda: response.code is not None or response.error,
+                  response)
+        if response.error is not None:
+            raise response.error
+
+    def _acknowledge(self, stream_id, length):
+        """Hand flow-control window back to the server for data read."""
+        if (not length or self.closed or self._h2.state_machine.state ==
+                h2.connection.ConnectionState.CLOSED):
+            return
+        try:
+            self._h2.acknowledge_received_data(length, stream_id)
+        except h2.exceptions.ProtocolError:
+            return
+        try:
+            self._flush()
+        except socket.error, e:
+            self._fail(URLError(e))
+
+    def _cancel(self, response):
+        # Nobody will read what is still buffered, so release its window.
+        unread, response._unacked = response._unacked, 0
+        response._chunks.clear()
+        self._acknowledge(response.stream_id, unread)
+        if self._streams.pop(response.stream_id, None) is None:
+            return
+        if (self.closed or self._h2.state_machine.state ==
+                h2.connection.ConnectionState.CLOSED):
+            return
+        try:
+            self._h2.reset_stream(response.stream_id,
+                                  h2.errors.ErrorCodes.CANCEL)
+        except h2.exceptions.ProtocolError:
+            # The stream or connection closed under us; nothing to reset.
+            return
+        try:
+            self._flush()
+        except socket.error, e:
+            self._fail(URLError(e))
+
+    def cancel(self, response):
+        """Stop receiving a response, sending RST_STREAM to the server."""
+        self.lock.acquire()
+        try:
+            self._cancel(response)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if not self.closed:
+                self._h2.close_connection()
+                try:
+                    self._flush()
+                except socket.error:
+                    pass
+                self._fail(URLError('connection closed'))
+        finally:
+            self.lock.release()
+
+
+class HTTP2Transport(Transport):
+    """Transport multiplexing all requests to a host over one HTTP/2
+    connection.
+
+    Concurrent requests from many threads, such as a burst of mailer or
+    mailers/status calls, share a single TLS connection instead of opening
+    one each. https URLs negotiate HTTP/2 with ALPN; plain http URLs use
+    HTTP/2 with prior knowledge. Requires the h2 package.
+    """
+    def __init__(self, timeout=60):
+        if h2 is None:
+            raise ImportError('HTTP2Transport requires the h2 package')
+        self.timeout = timeout
+        Transport.__init__(self)
+
+    def reset(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            connections, self._connections = self._connections, {}
+        finally:
+            self._lock.release()
+        for connection in connections.itervalues():
+            connection.close()
+
+    def _connection(self, parts):
+        key = (parts.scheme, parts.hostname, parts.port)
+        self._lock.acquire()
+        try:
+            connection = self._connections.get(key)
+            if connection is None or connection.closed:
+                secure = parts.scheme == 'https'
+                connection = _HTTP2Connection(parts.hostname,
+                        parts.port or (secure and 443 or 80), secure,
+                        self.timeout)
+                self._connections[key] = connection
+            return connection
+        finally:
+            self._lock.release()
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        response = self._connection(parts).request(method, parts.scheme,
+                parts.netloc, path, url, body, headers or {})
+        if response.code >= 400:
+            raise HTTPError(url, response.code, httplib.responses.get(
+                    response.code, ''), response.headers,
+                    StringIO(response.read()))
+        return response
+
+
+TRANSPORTS = {
+    'urllib': UrllibTransport,
+    'pooled': PooledTransport,
+    'http2': HTTP2Transport,
+}
+
+
 class MadMimi(object):
     """
     The client is straightforward to use:
@@ -127,6 +1308,22 @@ class MadMimi(object):
       <lists>
       </lists>
 
+    Or push a whole audience, sending only what changed since the last sync:
+
+      >>> mimi.sync_audience([(['Tav', 'Espian', 'tav@espians.com', ''],
+      ...     ['ampify'])], AudienceSnapshot('audience.snapshot'))
+      {'contacts': 1, 'subscribed': 1, 'unsubscribed': 0}
+
+    Requests go through a pluggable transport. Besides the default urllib2
+    one there are 'pooled', which keeps HTTP/1.1 connections alive, and
+    'http2', which multiplexes concurrent requests over one connection:
+
+      >>> mimi = MadMimi('user@foo.com', 'account-api-key', transport='http2')
+
+    The client can be pickled to hand it to multiprocessing workers, and is
+    safe to keep across os.fork() as in pre-forking servers: per-process
+    state is rebuilt on first use in the child.
+
     Send a transactional email:
 
         >>> mimi.send_message('John Doe','johndoe@gmail.com','Promotion Name',
@@ -145,11 +1342,51 @@ class MadMimi(object):
     base_url = 'http://api.madmimi.com/'
     secure_base_url = 'https://api.madmimi.com/'
 
-    def __init__(self, username, api_key):
+    def __init__(self, username, api_key, transport=None):
         self.username = username
         self.api_key = api_key
 
-        self.urlopen = urlopen
+        if transport is None:
+            transport = UrllibTransport()
+        elif isinstance(transport, basestring):
+            transport = TRANSPORTS[transport]()
+        self.transport = transport
+
+        self.urlopen = transport.urlopen
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_pid']
+        if state['urlopen'] == self.transport.urlopen:
+            del state['urlopen']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'urlopen' not in state:
+            self.urlopen = self.transport.urlopen
+        self._pid = os.getpid()
+
+    def close(self):
+        """Close the transport's open connections."""
+        # In a forked child the connections belong to the parent.
+        self._check_fork()
+        self.transport.close()
+
+    def _check_fork(self):
+        """Rebuild per-process state if we're running in a forked child."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._after_fork()
+
+    def _after_fork(self):
+        """Called in a forked child before its first request.
+
+        Anything that must not be shared with the parent process, such as
+        open connections, is dropped here. Configuration is kept.
+        """
+        self.transport.reset()
 
     def _get(self, method, **params):
         """Issue a GET request to Madmimi.
@@ -163,6 +1400,7 @@ class MadMimi(object):
         Returns:
             The result of the HTTP request as a string.
         """
+        self._check_fork()
         is_secure = params.get('is_secure')
         if is_secure:
             url = self.secure_base_url
@@ -186,6 +1424,7 @@ class MadMimi(object):
         Returns:
             The result of the HTTP request as a string.
         """
+        self._check_fork()
         is_secure = params.get('is_secure')
         if is_secure:
             url = self.secure_base_url + method
@@ -251,15 +1490,20 @@ class MadMimi(object):
             Nothing. The API doesn't provide a response.
         """
 
-        contacts = []
-        contacts.append((fields))
-        contacts.extend(contacts_data)
+        self.add_contacts_csv(encode_contacts(contacts_data, fields))
 
-        csvdata = StringIO()
-        writer = csv.writer(csvdata)
-        [writer.writerow(row) for row in contacts]
+    def add_contacts_csv(self, csv_data):
+        """Add audience members from CSV data.
+
+        Arguments:
+            csv_data: A CSV document whose first row names the fields, as
+                returned by encode_contacts or EncoderPool.encode_contacts.
 
-        self._post('audience_members', csv_file=csvdata.getvalue())
+        Returns:
+            Nothing. The API doesn't provide a response.
+        """
+
+        self._post('audience_members', csv_file=csv_data)
 
     def subscribe(self, email, audience_list):
         """Add an audience member to an audience list.
@@ -311,6 +1555,103 @@ class MadMimi(object):
         else:
             return parse_lists(response)
 
+    def sync_audience(self, audience, snapshot,
+                      fields=DEFAULT_CONTACT_FIELDS, chunk_size=1000):
+        """Bring your audience in line with a desired state.
+
+        Only contacts whose data changed since the last sync are uploaded,
+        and only memberships that were added or removed are sent.
+
+        Arguments:
+            audience: An iterable of (contact_data, list_names) pairs, where
+                contact_data is a tuple in the order given by fields and
+                list_names are the audience lists the contact should be in.
+            snapshot: The AudienceSnapshot holding the previously pushed
+                state. It is updated and saved, even if the sync fails
+                partway.
+            fields: A tuple containing the fields that will be represented.
+                It must include 'email'.
+            chunk_size: The maximum number of contacts per add_contacts
+                call. (Optional)
+
+        Returns:
+            A dictionary with the number of contacts uploaded and memberships
+            subscribed and unsubscribed.
+            {'contacts': 10, 'subscribed': 3, 'unsubscribed': 1}
+        """
+
+        email_index = list(fields).index('email')
+        counts = {'contacts': 0, 'subscribed': 0, 'unsubscribed': 0}
+        contacts = []
+        digests = []
+        subscriptions = []
+        seen = set()
+
+        # The snapshot is only updated once a request has gone through, so
+        # that a failed sync can be retried with the same snapshot.
+        def subscribe(email, audience_list):
+            self.subscribe(email, audience_list)
+            snapshot.memberships[email] = snapshot.memberships.get(
+                    email, frozenset()) | frozenset([audience_list])
+            counts['subscribed'] += 1
+
+        def unsubscribe(email, audience_list):
+            self.unsubscribe(email, audience_list)
+            snapshot.memberships[email] = snapshot.memberships.get(
+                    email, frozenset()) - frozenset([audience_list])
+            counts['unsubscribed'] += 1
+
+        def flush():
+            # Contacts go first so that new members exist before they are
+            # subscribed to any list.
+            if contacts:
+                self.add_contacts(contacts, fields=fields)
+                snapshot.contacts.update(digests)
+                counts['contacts'] += len(contacts)
+                del contacts[:]
+                del digests[:]
+            while subscriptions:
+                subscribe(*subscriptions[0])
+                del subscriptions[0]
+
+        # Whatever went through is saved even if a request fails, so that
+        # the next sync picks up where this one stopped.
+        try:
+            for contact_data, list_names in audience:
+                email = contact_data[email_index]
+                seen.add(email)
+
+                digest = contact_digest(contact_data)
+                if snapshot.contacts.get(email) != digest:
+                    contacts.append(contact_data)
+                    digests.append((email, digest))
+
+                wanted = frozenset(list_names)
+                current = snapshot.memberships.get(email, frozenset())
+                subscriptions.extend((email, name)
+                                     for name in wanted - current)
+                for audience_list in current - wanted:
+                    unsubscribe(email, audience_list)
+
+                if (len(contacts) >= chunk_size or
+                        len(subscriptions) >= chunk_size):
+                    flush()
+
+            flush()
+
+            # Contacts missing from the desired state are removed from all of
+            # their lists. The API can't delete the contacts themselves.
+            pushed = set(snapshot.contacts) | set(snapshot.memberships)
+            for email in pushed - seen:
+                for audience_list in snapshot.memberships.get(email, ()):
+                    unsubscribe(email, audience_list)
+                snapshot.contacts.pop(email, None)
+                snapshot.memberships.pop(email, None)
+        finally:
+            snapshot.save()
+
+        return counts
+
     def send_message(self, name, email, promotion, subject, sender, body={}):
         """Sends a message to a user.
 
@@ -322,18 +1663,16 @@ class MadMimi(object):
             sender: Email address the email should appear to be from.
             body: Dict holding variables for the promotion template.
                     {'variable': 'Replcement value'}
+                  Or a body already serialized with encode_body.
 
         Returns:
             The transaction id of the message if successful.
             The error if unsuccessful.
         """
 
-        # The YAML dump will fail if it encounters non-strings
-        for item, value in body.iteritems():
-            body[item] = str(value)
-
         recipients = "%s <%s>" % (name, email)
-        body = dump(body)
+        if not isinstance(body, basestring):
+            body = encode_body(body)
 
         return self._post('mailer', promotion_name=promotion,
                 recipients=recipients, subject=subject, sender=sender,
@@ -347,17 +1686,15 @@ class MadMimi(object):
             promotion: Name of the Mad Mimi promotion to send.
             body: Dict holding variables for the promotion template.
                     {'variable': 'Replcement value'}
+                  Or a body already serialized with encode_body.
 
         Returns:
             The transaction id of the message if successful.
             The error if unsuccessful.
         """
 
-        # The YAML dump will fail if it encounters non-strings
-        for item, value in body.iteritems():
-            body[item] = str(value)
-
-        body = dump(body)
+        if not isinstance(body, basestring):
+            body = encode_body(body)
 
         return self._post('mailer/to_list', promotion_name=promotion,
                 list_name=list_name, body=body, is_secure=True)
@@ -398,7 +1735,436 @@ class MadMimi(object):
 
         return self._get(url)
 
-    def promotion_stats(self):
-        """Get an XML document containing stats for all your promotions."""
+    def promotion_stats(self, as_xml=True):
+        """Get stats for all your promotions.
+
+        Arguments:
+            as_xml: If true, the result will be the raw XML response. If False
+                the result will be a python dictionary of promotion stats.
+                Default is True. (Optional)
+
+        Returns:
+            The raw XML response or a dictionary of promotion ids and stats.
+            {1234: <PromotionStats object>, 5678: <PromotionStats object>}
+        """
+        response = self._get('promotions.xml')
+        if as_xml:
+            return response
+        else:
+            return parse_promotion_stats(response)
+
+
+class Checkpoint(object):
+    """Tracks which jobs of a bulk run have completed.
+
+    Jobs are numbered in input order. The checkpoint stores the number of
+    leading jobs that are done plus any completed out of order, so that a
+    resumed run skips exactly the jobs that already went through.
+
+    params describe what the job numbers refer to, such as the command,
+    input file and chunk size. Loading a checkpoint saved with different
+    params raises ValueError, since its job numbers would point at the
+    wrong rows.
+    """
+    def __init__(self, path=None, params=None):
+        self.path = path
+        # Round trip through JSON so params compare equal once loaded.
+        self.params = json.loads(json.dumps(params or {}))
+        self.done = 0
+        self.completed = set()
+
+        if path and os.path.exists(path):
+            checkpoint = open(path, 'rb')
+            try:
+                state = json.load(checkpoint)
+            finally:
+                checkpoint.close()
+            if state.get('params', {}) != self.params:
+                raise ValueError('checkpoint %s was saved for %s, not %s'
+                                 % (path, state.get('params', {}),
+                                    self.params))
+            self.done = state['done']
+            self.completed = set(state['completed'])
+
+    def __contains__(self, index):
+        return index < self.done or index in self.completed
+
+    def add(self, index):
+        """Mark a job as completed."""
+        self.completed.add(index)
+        while self.done in self.completed:
+            self.completed.remove(self.done)
+            self.done += 1
+
+    def save(self):
+        """Write the checkpoint to disk, if it has a path."""
+        if not self.path:
+            return
+
+        tmp_path = self.path + '.tmp'
+        checkpoint = open(tmp_path, 'wb')
+        try:
+            json.dump({'params': self.params,
+                       'done': self.done,
+                       'completed': sorted(self.completed)}, checkpoint)
+        finally:
+            checkpoint.close()
+
+        replace_file(tmp_path, self.path)
+
+
+class Progress(object):
+    """Live throughput and ETA display for bulk runs."""
+    def __init__(self, total=None, stream=sys.stderr, interval=0.5):
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.count = 0
+        self.skipped = 0
+        self.started = self.last_write = time.time()
+
+    def update(self, count, skipped=False):
+        """Record count more units of work as done."""
+        self.count += count
+        if skipped:
+            self.skipped += count
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        """Write the current progress line."""
+        self.last_write = time.time()
+        elapsed = max(self.last_write - self.started, 1e-6)
+        rate = (self.count - self.skipped) / elapsed
+
+        if self.total is None:
+            line = '%d done' % self.count
+        else:
+            line = '%d/%d done' % (self.count, self.total)
+        line += ', %.1f/s' % rate
+        if self.total is not None and rate:
+            eta = int((self.total - self.count) / rate)
+            line += ', ETA %s' % datetime.timedelta(seconds=max(eta, 0))
+
+        self.stream.write('\r%s  ' % line)
+        self.stream.flush()
+
+    def finish(self):
+        """Write the final progress line."""
+        self.write()
+        self.stream.write('\n')
+
+
+def run_bulk(func, jobs, concurrency=4, checkpoint=None, progress=None,
+             output=None, save_interval=1.0):
+    """Run func over jobs in a pool of threads.
+
+    Arguments:
+        func: Called with the payload of every job.
+        jobs: An iterable of (index, weight, payload) tuples. index numbers
+            the job in input order and weight is how much it counts towards
+            progress, e.g. the number of rows in a chunk.
+        concurrency: The number of jobs to run at the same time. (Optional)
+        checkpoint: The Checkpoint used to skip and record finished jobs.
+            (Optional)
+        progress: A Progress to report to. (Optional)
+        output: A file that is flushed before every checkpoint save, so the
+            checkpoint never gets ahead of the output. (Optional)
+        save_interval: Seconds between checkpoint saves. (Optional)
+
+    Returns:
+        A generator of (payload, result) pairs in completion order. Jobs are
+        only checkpointed once the consumer has handled their result. If a
+        job fails, the jobs already running are allowed to finish and the
+        first error is raised.
+    """
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+
+    todo = Queue.Queue(concurrency * 2)
+    results = Queue.Queue()
+    stop = threading.Event()
+    skipped = object()
+
+    def feed():
+        try:
+            for job in jobs:
+                if stop.is_set():
+                    break
+                if job[0] in checkpoint:
+                    results.put((job, skipped, None))
+                else:
+                    todo.put(job)
+        except Exception:
+            results.put((None, None, sys.exc_info()))
+        for i in range(concurrency):
+            todo.put(None)
+
+    def work():
+        while True:
+            job = todo.get()
+            if job is None:
+                results.put(None)
+                return
+            if stop.is_set():
+                continue
+            try:
+                results.put((job, func(job[2]), None))
+            except Exception:
+                results.put((job, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for i in range(concurrency))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def save():
+        if output is not None:
+            output.flush()
+        checkpoint.save()
+
+    error = None
+    finished = 0
+    last_save = time.time()
+    try:
+        while finished < concurrency:
+            try:
+                # A timeout keeps the wait interruptible with Ctrl-C.
+                item = results.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if item is None:
+                finished += 1
+                continue
+
+            job, result, exc_info = item
+            if exc_info is not None:
+                stop.set()
+                error = error or exc_info
+                continue
+
+            if result is not skipped:
+                yield job[2], result
+            checkpoint.add(job[0])
+            if progress is not None:
+                progress.update(job[1], skipped=result is skipped)
+
+            if time.time() - last_save >= save_interval:
+                save()
+                last_save = time.time()
+    finally:
+        stop.set()
+        save()
+        if progress is not None:
+            progress.finish()
+
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+
+def _open(path, mode='rb'):
+    """Open path, treating '-' as stdin or stdout."""
+    if path == '-':
+        if 'r' in mode:
+            return sys.stdin
+        return sys.stdout
+    return open(path, mode)
+
+
+def _count_rows(path):
+    """Count the CSV rows in path, or None for stdin."""
+    if path == '-':
+        return None
+    source = open(path, 'rb')
+    try:
+        return sum(1 for row in csv.reader(source))
+    finally:
+        source.close()
+
+
+def _chunks(rows, size):
+    """Split rows into numbered (index, weight, chunk) jobs."""
+    chunk = []
+    index = 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield index, len(chunk), chunk
+            chunk = []
+            index += 1
+    if chunk:
+        yield index, len(chunk), chunk
+
+
+def _import_contacts(mimi, options, header, rows, output, checkpoint,
+                     progress):
+    fields = tuple(header)
+
+    def upload(chunk):
+        mimi.add_contacts(chunk, fields=fields)
+
+    for chunk, result in run_bulk(upload, _chunks(rows, options.chunk_size),
+            options.concurrency, checkpoint, progress, output):
+        pass
+
+
+def _send_bulk(mimi, options, header, rows, output, checkpoint, progress):
+    writer = csv.writer(output)
+
+    def send(row):
+        body = dict(row)
+        name = body.pop('name', '')
+        email = body.pop('email')
+        return mimi.send_message(name, email, options.promotion,
+                options.subject, options.sender, body)
+
+    jobs = ((index, 1, dict(zip(header, row)))
+            for index, row in enumerate(rows))
+    for row, transaction_id in run_bulk(send, jobs, options.concurrency,
+            checkpoint, progress, output):
+        writer.writerow([transaction_id.strip(), row['email']])
+
+
+def _poll_status(mimi, options, header, rows, output, checkpoint, progress):
+    writer = csv.writer(output)
+
+    def poll(transaction_id):
+        return mimi.message_status(transaction_id)
+
+    jobs = ((index, 1, row[0]) for index, row in enumerate(rows) if row)
+    for transaction_id, status in run_bulk(poll, jobs, options.concurrency,
+            checkpoint, progress, output):
+        writer.writerow([transaction_id, status.strip()])
+
+
+def _export_suppressed(mimi, options, header, rows, output, checkpoint,
+                       progress):
+    since = datetime.datetime.strptime(options.since, '%Y-%m-%d')
+    output.write(mimi.supressed_since(since))
+
+
+# Each command maps to its function, whether it reads an input file and the
+# columns its header row must have, or None if the input has no header.
+COMMANDS = {
+    'import-contacts': (_import_contacts, True, ()),
+    'send-bulk': (_send_bulk, True, ('email',)),
+    'poll-status': (_poll_status, True, None),
+    'export-suppressed': (_export_suppressed, False, None),
+}
+
+USAGE = """%prog [options] command [input]
+
+Commands:
+  import-contacts FILE   Add the contacts in a CSV file. The first row
+                         names the fields.
+  send-bulk FILE         Send a promotion to every row of a CSV file with
+                         'name' and 'email' columns; other columns become
+                         template variables. Writes transaction_id,email.
+  poll-status FILE       Look up the status of the transaction ids in the
+                         first column of FILE. Writes transaction_id,status.
+  export-suppressed      Write the addresses suppressed since --since.
+
+Use - as FILE to read from stdin."""
+
+
+def main(argv=None):
+    """Entry point for python -m madmimi."""
+    from optparse import OptionParser
+
+    parser = OptionParser(usage=USAGE)
+    parser.add_option('-u', '--username',
+            default=os.environ.get('MADMIMI_USERNAME'),
+            help='Mad Mimi username [$MADMIMI_USERNAME]')
+    parser.add_option('-k', '--api-key',
+            default=os.environ.get('MADMIMI_API_KEY'),
+            help='Mad Mimi API key [$MADMIMI_API_KEY]')
+    parser.add_option('-o', '--output', default='-',
+            help='file to write results to [default: stdout]')
+    parser.add_option('-c', '--concurrency', type='int', default=4,
+            help='number of requests in flight [default: %default]')
+    parser.add_option('-t', '--transport', default='urllib',
+            choices=sorted(TRANSPORTS),
+            help='HTTP transport: %s [default: %%default]'
+                 % ', '.join(sorted(TRANSPORTS)))
+    parser.add_option('--checkpoint',
+            help='file recording progress; rerun with the same file to '
+                 'resume an interrupted run')
+    parser.add_option('--chunk-size', type='int', default=1000,
+            help='contacts per import request [default: %default]')
+    parser.add_option('--promotion', help='promotion to send')
+    parser.add_option('--subject', help='subject of the message')
+    parser.add_option('--sender', help='address the message is from')
+    parser.add_option('--since', help='date as YYYY-MM-DD')
+    parser.add_option('-q', '--quiet', action='store_true',
+            help="don't show progress")
+
+    options, args = parser.parse_args(argv)
+    if not args or args[0] not in COMMANDS:
+        parser.error('expected one of: %s' % ', '.join(sorted(COMMANDS)))
+    command, takes_input, columns = COMMANDS[args[0]]
+    if takes_input and len(args) != 2:
+        parser.error('%s takes an input file' % args[0])
+    if not options.username or not options.api_key:
+        parser.error('a username and API key are required')
+    if args[0] == 'send-bulk' and not (options.promotion and
+            options.subject and options.sender):
+        parser.error('send-bulk needs --promotion, --subject and --sender')
+    if args[0] == 'export-suppressed' and not options.since:
+        parser.error('export-suppressed needs --since')
+
+    params = {'command': args[0]}
+    if takes_input:
+        params['input'] = args[1] == '-' and '-' or os.path.abspath(args[1])
+    if args[0] == 'import-contacts':
+        params['chunk_size'] = options.chunk_size
+    resuming = options.checkpoint and os.path.exists(options.checkpoint)
+    try:
+        checkpoint = Checkpoint(options.checkpoint, params)
+    except ValueError, e:
+        parser.error('can\'t resume: %s' % e)
+
+    # Open the input before the output, so a bad input path doesn't wipe
+    # the output of a previous run.
+    source = None
+    header = None
+    rows = None
+    progress = None
+    if takes_input:
+        try:
+            source = _open(args[1])
+        except IOError, e:
+            parser.error(str(e))
+        rows = csv.reader(source)
+        if columns is not None:
+            header = next(rows, None)
+            if not header or not any(header):
+                parser.error('%s has no header row' % args[1])
+            missing = [column for column in columns if column not in header]
+            if missing:
+                parser.error('%s has no %s column'
+                             % (args[1], ', '.join(missing)))
+        if not options.quiet:
+            total = _count_rows(args[1])
+            if total is not None and header is not None:
+                total -= 1
+            progress = Progress(total)
+
+    # Append to the output of the interrupted run when resuming.
+    output = _open(options.output, resuming and 'ab' or 'wb')
+    mimi = MadMimi(options.username, options.api_key, options.transport)
+
+    try:
+        command(mimi, options, header, rows, output, checkpoint, progress)
+    finally:
+        if source not in (None, sys.stdin):
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+        mimi.close()
+
+    return 0
+
 
-        return self._get('promotions.xml')
+if __name__ == '__main__':
+    sys.exit(main())
@@ -31,9 +31,19 @@ API.
 __author__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
 __maintainer__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
 
-from mock import Mock
+from mock import Mock, patch
+import BaseHTTPServer
 import datetime
+import os
+import pickle
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
 import unittest
+from urllib2 import HTTPError, URLError
 from urllib import urlencode
 from urllib import quote
 from urlparse import urlparse
@@ -49,6 +59,15 @@ try:
 except ImportError:
     from cgi import parse_qs
 
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.settings
+    import hyperframe.frame
+except ImportError:
+    h2 = None
+
 import madmimi
 
 
@@ -281,6 +300,856 @@ class MadMimiTest(unittest.TestCase):
                 urlencode(self.expected_args))
         self.mimi.urlopen.assert_called_with(expected_url)
     
+class SyncAudienceTest(unittest.TestCase):
+    """Tests for MadMimi.sync_audience."""
+    
+    def setUp(self):
+        """Setup fixture."""
+        
+        self.fields = ('first_name', 'last_name', 'email')
+        self.audience = [
+            (('John', 'Doe', 'john@doe.com'), ['Dinosaur']),
+            (('Jane', 'Doe', 'jane@doe.com'), ['Dinosaur', 'Fossil']),
+        ]
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'audience.snapshot')
+        
+        self.mimi = madmimi.MadMimi('test@test.com', '23890889df8909fs09s09')
+        self.mimi.urlopen = Mock()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def sync(self, audience):
+        self.mimi.urlopen.reset_mock()
+        return self.mimi.sync_audience(audience,
+                madmimi.AudienceSnapshot(self.path), fields=self.fields)
+    
+    def called_urls(self):
+        return [call[0][0] for call in self.mimi.urlopen.call_args_list]
+    
+    def test_first_sync(self):
+        """Test that the first sync pushes every contact and membership."""
+        
+        counts = self.sync(self.audience)
+        
+        self.assertEqual(
+            {'contacts': 2, 'subscribed': 3, 'unsubscribed': 0}, counts)
+        self.assertEqual('%saudience_members' % self.mimi.base_url,
+                self.called_urls()[0])
+    
+    def test_unchanged_sync(self):
+        """Test that syncing an unchanged audience issues no requests."""
+        
+        self.sync(self.audience)
+        counts = self.sync(self.audience)
+        
+        self.assertEqual(
+            {'contacts': 0, 'subscribed': 0, 'unsubscribed': 0}, counts)
+        self.assertFalse(self.mimi.urlopen.called)
+    
+    def test_changed_sync(self):
+        """Test that only changed contacts and memberships are sent."""
+        
+        self.sync(self.audience)
+        counts = self.sync([
+            (('John', 'Dough', 'john@doe.com'), ['Dinosaur']),
+            (('Jane', 'Doe', 'jane@doe.com'), ['Fossil']),
+        ])
+        
+        self.assertEqual(
+            {'contacts': 1, 'subscribed': 0, 'unsubscribed': 1}, counts)
+        called_args = [parse_qs(call[0][1])
+                for call in self.mimi.urlopen.call_args_list
+                if call[0][0].endswith('audience_members')][0]
+        self.assertTrue('Dough' in called_args['csv_file'][0])
+        self.assertFalse('jane@doe.com' in called_args['csv_file'][0])
+        self.assertTrue('%saudience_lists/Dinosaur/remove'
+                % self.mimi.base_url in self.called_urls())
+    
+    def test_removed_contact(self):
+        """Test that contacts left out are removed from their lists."""
+        
+        self.sync(self.audience)
+        counts = self.sync(self.audience[:1])
+        
+        self.assertEqual(
+            {'contacts': 0, 'subscribed': 0, 'unsubscribed': 2}, counts)
+        self.assertEqual(['john@doe.com'],
+                madmimi.AudienceSnapshot(self.path).contacts.keys())
+    
+    def test_failed_sync(self):
+        """Test that a failed sync is saved and can be picked up later."""
+        
+        # John's contact and subscription go through, Jane's upload fails.
+        self.mimi.urlopen.side_effect = [Mock(), Mock(), IOError()]
+        self.assertRaises(IOError, self.mimi.sync_audience, self.audience,
+                madmimi.AudienceSnapshot(self.path), fields=self.fields,
+                chunk_size=1)
+        
+        self.mimi.urlopen.side_effect = None
+        counts = self.mimi.sync_audience(self.audience,
+                madmimi.AudienceSnapshot(self.path), fields=self.fields)
+        
+        self.assertEqual(
+            {'contacts': 1, 'subscribed': 2, 'unsubscribed': 0}, counts)
+        self.assertEqual(['jane@doe.com', 'john@doe.com'],
+                sorted(madmimi.AudienceSnapshot(self.path).contacts))
+    
+class BulkTest(unittest.TestCase):
+    """Tests for the bulk runner and command line tool."""
+    
+    def setUp(self):
+        """Setup fixture."""
+        
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.tmpdir, 'checkpoint')
+        self.progress_stream = StringIO()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def write_file(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        target = open(path, 'wb')
+        target.write(data)
+        target.close()
+        return path
+    
+    def test_checkpoint(self):
+        """Test that a checkpoint records out of order jobs."""
+        
+        checkpoint = madmimi.Checkpoint(self.checkpoint_path)
+        for index in (0, 1, 3):
+            checkpoint.add(index)
+        checkpoint.save()
+        
+        checkpoint = madmimi.Checkpoint(self.checkpoint_path)
+        self.assertEqual(2, checkpoint.done)
+        self.assertEqual([0, 1, 3], [i for i in range(5) if i in checkpoint])
+    
+    def test_run_bulk_resume(self):
+        """Test that run_bulk skips jobs recorded in the checkpoint."""
+        
+        checkpoint = madmimi.Checkpoint(self.checkpoint_path)
+        checkpoint.add(0)
+        checkpoint.add(2)
+        jobs = [(index, 1, index) for index in range(5)]
+        progress = madmimi.Progress(5, stream=self.progress_stream)
+        
+        results = sorted(madmimi.run_bulk(lambda x: x * 10, jobs,
+                concurrency=2, checkpoint=checkpoint, progress=progress))
+        
+        self.assertEqual([(1, 10), (3, 30), (4, 40)], results)
+        self.assertEqual(5, madmimi.Checkpoint(self.checkpoint_path).done)
+        self.assertEqual(5, progress.count)
+    
+    def test_run_bulk_error(self):
+        """Test that run_bulk saves completed jobs before raising."""
+        
+        def fail_on_two(x):
+            if x == 2:
+                raise ValueError(x)
+            return x
+        
+        checkpoint = madmimi.Checkpoint(self.checkpoint_path)
+        jobs = [(index, 1, index) for index in range(3)]
+        results = []
+        
+        def consume():
+            for result in madmimi.run_bulk(fail_on_two, jobs, concurrency=1,
+                    checkpoint=checkpoint):
+                results.append(result)
+        
+        self.assertRaises(ValueError, consume)
+        self.assertEqual([(0, 0), (1, 1)], results)
+        self.assertEqual(2, madmimi.Checkpoint(self.checkpoint_path).done)
+    
+    def test_import_contacts_command(self):
+        """Test that import-contacts uploads the file in chunks."""
+        
+        source = self.write_file('contacts.csv', 'first_name,email\r\n'
+                'John,john@doe.com\r\nJane,jane@doe.com\r\n'
+                'Jim,jim@doe.com\r\n')
+        
+        urlopen = Mock()
+        with patch('madmimi.urlopen', urlopen):
+            madmimi.main(['-u', 'test@test.com', '-k', 'key', '-q',
+                    '-o', os.path.join(self.tmpdir, 'out'),
+                    '--chunk-size', '2', 'import-contacts', source])
+        
+        csv_files = sorted(parse_qs(call[0][1])['csv_file'][0]
+                for call in urlopen.call_args_list)
+        self.assertEqual(['first_name,email\r\nJim,jim@doe.com\r\n',
+                'first_name,email\r\nJohn,john@doe.com\r\n'
+                'Jane,jane@doe.com\r\n'], csv_files)
+    
+    def test_checkpoint_params(self):
+        """Test that a checkpoint only resumes the run it was saved for."""
+        
+        checkpoint = madmimi.Checkpoint(self.checkpoint_path,
+                {'command': 'import-contacts', 'chunk_size': 2})
+        checkpoint.add(0)
+        checkpoint.save()
+        
+        self.assertRaises(ValueError, madmimi.Checkpoint,
+                self.checkpoint_path,
+                {'command': 'import-contacts', 'chunk_size': 3})
+        checkpoint = madmimi.Checkpoint(self.checkpoint_path,
+                {'command': 'import-contacts', 'chunk_size': 2})
+        self.assertEqual(1, checkpoint.done)
+    
+    def test_resume_chunk_size_mismatch(self):
+        """Test that import-contacts refuses a different chunk size."""
+        
+        source = self.write_file('contacts.csv',
+                'first_name,email\r\nJohn,john@doe.com\r\n')
+        args = ['-u', 'test@test.com', '-k', 'key', '-q',
+                '--checkpoint', self.checkpoint_path,
+                '-o', os.path.join(self.tmpdir, 'out'), 'import-contacts',
+                source]
+        
+        urlopen = Mock()
+        with patch('madmimi.urlopen', urlopen):
+            madmimi.main(args + ['--chunk-size', '2'])
+            with patch('sys.stderr', StringIO()):
+                self.assertRaises(SystemExit, madmimi.main,
+                        args + ['--chunk-size', '3'])
+        self.assertEqual(1, urlopen.call_count)
+    
+    def test_empty_input(self):
+        """Test that an input without a header row is a usage error."""
+        
+        output = self.write_file('out', '1146680279,john@doe.com\r\n')
+        for name, data in (('empty.csv', ''), ('blank.csv', '\r\n')):
+            source = self.write_file(name, data)
+            with patch('sys.stderr', StringIO()):
+                self.assertRaises(SystemExit, madmimi.main, ['-u',
+                        'test@test.com', '-k', 'key', '-o', output,
+                        'import-contacts', source])
+        self.assertEqual('1146680279,john@doe.com\r\n', open(output).read())
+    
+    def test_missing_input_keeps_output(self):
+        """Test that a bad input path leaves the output file alone."""
+        
+        output = self.write_file('out', '1146680279,john@doe.com\r\n')
+        
+        with patch('sys.stderr', StringIO()):
+            self.assertRaises(SystemExit, madmimi.main, ['-u',
+                    'test@test.com', '-k', 'key', '-q', '-o', output,
+                    'poll-status', os.path.join(self.tmpdir, 'missing')])
+        self.assertEqual('1146680279,john@doe.com\r\n', open(output).read())
+    
+    def test_send_bulk_command(self):
+        """Test that send-bulk writes transaction ids to the output."""
+        
+        source = self.write_file('recipients.csv',
+                'name,email,var1\r\nJohn Doe,john@doe.com,abc\r\n')
+        output = os.path.join(self.tmpdir, 'out')
+        
+        urlopen = Mock()
+        urlopen.return_value.read.return_value = '1146680279'
+        with patch('madmimi.urlopen', urlopen):
+            madmimi.main(['-u', 'test@test.com', '-k', 'key', '-q',
+                    '-o', output, '--promotion', 'Test Promotion',
+                    '--subject', 'Test Mailing', '--sender', 'me@doe.com',
+                    'send-bulk', source])
+        
+        called_args = parse_qs(urlopen.call_args[0][1])
+        self.assertEqual('John Doe <john@doe.com>',
+                called_args['recipients'][0])
+        self.assertEqual({'var1': 'abc'}, yaml.load(called_args['body'][0]))
+        self.assertEqual('1146680279,john@doe.com\r\n', open(output).read())
+    
+class PromotionStatsTest(unittest.TestCase):
+    """Tests for promotion stats parsing and storage."""
+    
+    def setUp(self):
+        """Setup fixture."""
+        
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'stats')
+        
+        self.mimi = madmimi.MadMimi('test@test.com', '23890889df8909fs09s09')
+        self.mimi.urlopen = Mock()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def stats(self, sends, opens, clicks=0):
+        return {1234: madmimi.PromotionStats(1234, 'Test Promotion',
+                sends=sends, opens=opens, clicks=clicks)}
+    
+    def test_parse_promotion_stats(self):
+        """Test that counters are read from attributes and elements."""
+        
+        self.mimi.urlopen.return_value = StringIO(
+                '<promotions>\n'
+                '  <promotion id="1234" name="Test Promotion" sends="10">\n'
+                '    <opens>4</opens>\n'
+                '  </promotion>\n'
+                '</promotions>\n')
+        stats = self.mimi.promotion_stats(as_xml=False)
+        
+        self.assertEqual([1234], stats.keys())
+        self.assertEqual('Test Promotion', stats[1234].name)
+        self.assertEqual((10, 4, 0, 0, 0, 0), stats[1234].counters())
+    
+    def test_store_only_changes(self):
+        """Test that unchanged snapshots don't add rows."""
+        
+        store = madmimi.PromotionStatsStore(self.path)
+        self.assertEqual(1, store.append(self.stats(10, 2), 100))
+        self.assertEqual(0, store.append(self.stats(10, 2), 200))
+        self.assertEqual(1, store.append(self.stats(15, 3), 300))
+        
+        store = madmimi.PromotionStatsStore(self.path)
+        self.assertEqual(2, store.length)
+        self.assertEqual('Test Promotion', store.names[1234])
+        self.assertEqual(0, store.append(self.stats(15, 3), 400))
+    
+    def test_series(self):
+        """Test range queries over the stored series."""
+        
+        store = madmimi.PromotionStatsStore(self.path)
+        for timestamp, sends in ((100, 10), (200, 20), (300, 40)):
+            store.append(self.stats(sends, 1), timestamp)
+        
+        series = store.series(1234, start=150, counters=('sends',))
+        self.assertEqual({'time': [200.0, 300.0], 'sends': [20, 40]}, series)
+        self.assertEqual(30, store.change(1234, 100)['sends'])
+        self.assertEqual(10, store.change(1234, 150, 250)['sends'])
+        self.assertEqual(None, store.value_at(1234, 50))
+    
+    def test_reopen_many_promotions(self):
+        """Test that reopening finds each promotion's last row."""
+        
+        with patch.object(madmimi.PromotionStatsStore, 'block_size', 2):
+            store = madmimi.PromotionStatsStore(self.path)
+            for timestamp in range(1, 6):
+                store.append({
+                    1: madmimi.PromotionStats(1, sends=timestamp),
+                    2: madmimi.PromotionStats(2, sends=min(timestamp, 2)),
+                    3: madmimi.PromotionStats(3, sends=1),
+                }, timestamp)
+            
+            store = madmimi.PromotionStatsStore(self.path)
+            self.assertEqual(5.0, store.last_time)
+            self.assertEqual(0, store.append({
+                1: madmimi.PromotionStats(1, sends=5),
+                2: madmimi.PromotionStats(2, sends=2),
+                3: madmimi.PromotionStats(3, sends=1),
+            }, 6))
+            self.assertEqual(1, store.value_at(3, 6)['sends'])
+            self.assertEqual(2, store.change(1, 3, 5)['sends'])
+    
+    def test_partial_row(self):
+        """Test that a partially written row is dropped on open."""
+        
+        store = madmimi.PromotionStatsStore(self.path)
+        store.append(self.stats(10, 2), 100)
+        column = open(os.path.join(self.path, 'time'), 'ab')
+        column.write('\0' * 8)
+        column.close()
+        
+        store = madmimi.PromotionStatsStore(self.path)
+        self.assertEqual(1, store.length)
+        self.assertEqual([100.0], store.series(1234)['time'])
+    
+class ProcessTest(unittest.TestCase):
+    """Tests for using the client across processes."""
+    
+    def setUp(self):
+        """Setup fixture."""
+        
+        self.mimi = madmimi.MadMimi('test@test.com', '23890889df8909fs09s09')
+    
+    def test_pickle(self):
+        """Test that a pickled client keeps its configuration."""
+        
+        mimi = pickle.loads(pickle.dumps(self.mimi))
+        
+        self.assertEqual(self.mimi.username, mimi.username)
+        self.assertEqual(self.mimi.api_key, mimi.api_key)
+        self.assertEqual(mimi.transport.urlopen, mimi.urlopen)
+    
+    def test_fork_detection(self):
+        """Test that per-process state is rebuilt in a new process."""
+        
+        self.mimi.urlopen = Mock()
+        self.mimi._after_fork = Mock()
+        self.mimi.lists(as_xml=True)
+        self.assertFalse(self.mimi._after_fork.called)
+        
+        self.mimi._pid = -1
+        self.mimi.lists(as_xml=True)
+        self.assertTrue(self.mimi._after_fork.called)
+        self.assertEqual(os.getpid(), self.mimi._pid)
+    
+    def test_encoder_pool(self):
+        """Test that the pool encodes the same as the client does."""
+        
+        fields = ('first_name', 'email')
+        chunks = [[('John', 'john@doe.com')], [('Jane', 'jane@doe.com')]]
+        bodies = [{'abc': 123}, {'def': 456}]
+        responses = [generate_lists([(1, 'Dinosaur', '71056')]).getvalue()]
+        
+        with madmimi.EncoderPool(2) as pool:
+            csv_files = list(pool.encode_contacts(chunks, fields))
+            encoded_bodies = list(pool.encode_bodies(bodies))
+            lists = list(pool.parse_lists(responses))
+        
+        self.assertEqual([madmimi.encode_contacts(chunk, fields)
+                for chunk in chunks], csv_files)
+        self.assertEqual([{'abc': '123'}, {'def': '456'}],
+                [yaml.load(body) for body in encoded_bodies])
+        self.assertEqual(['Dinosaur'], lists[0].keys())
+    
+    def test_send_encoded_body(self):
+        """Test that a pre-serialized body is sent as it is."""
+        
+        self.mimi.urlopen = Mock()
+        body = madmimi.encode_body({'abc': 123})
+        self.mimi.send_message('John Doe', 'john@doe.com', 'Test Promotion',
+                'Test Mailing', 'mimiuser@doe.com', body)
+        
+        called_args = parse_qs(self.mimi.urlopen.call_args[0][1])
+        self.assertEqual(body, called_args['body'][0])
+    
+class TransportTest(unittest.TestCase):
+    """Tests for the HTTP transports against local servers."""
+    
+    def test_urllib_transport(self):
+        """Test that the default transport is urllib2.urlopen."""
+        
+        urlopen = Mock()
+        with patch('madmimi.urlopen', urlopen):
+            mimi = madmimi.MadMimi('test@test.com', '23890889df8909fs09s09')
+            mimi.add_list('Dinosaur')
+        
+        self.assertTrue(isinstance(mimi.transport, madmimi.UrllibTransport))
+        self.assertEqual('%saudience_lists' % mimi.base_url,
+                urlopen.call_args[0][0])
+    
+    def test_pooled_transport(self):
+        """Test that the pooled transport reuses its connection."""
+        
+        server = HTTP11StandIn()
+        transport = madmimi.PooledTransport()
+        try:
+            url = 'http://127.0.0.1:%d' % server.port
+            for i in range(3):
+                self.assertEqual('GET /lists.xml ',
+                        transport.request('GET', url + '/lists.xml').read())
+            response = transport.request('POST', url + '/mailer',
+                    iter(['a' * 10000, 'b' * 10000]))
+            self.assertEqual('POST /mailer %s' % ('a' * 10000 + 'b' * 10000),
+                    response.read())
+            self.assertRaises(HTTPError, transport.request, 'GET',
+                    url + '/missing')
+        finally:
+            transport.close()
+            server.shutdown()
+        
+        self.assertEqual(1, server.connections)
+    
+    def test_pooled_timeout(self):
+        """Test that a POST that times out is not sent again."""
+        
+        server = HTTP11StandIn()
+        transport = madmimi.PooledTransport(timeout=0.5)
+        url = 'http://127.0.0.1:%d' % server.port
+        try:
+            transport.urlopen(url + '/mailer', 'body=1').read()
+            self.assertRaises(socket.timeout, transport.urlopen,
+                    url + '/slow', 'body=2')
+        finally:
+            transport.close()
+            server.shutdown()
+        
+        self.assertEqual(['/mailer', '/slow'], server.paths)
+    
+    def test_pooled_dropped_connection(self):
+        """Test that idle connections closed by the server aren't used."""
+        
+        server = HTTP11StandIn()
+        transport = madmimi.PooledTransport()
+        url = 'http://127.0.0.1:%d' % server.port
+        try:
+            transport.urlopen(url + '/close', 'body=1').read()
+            time.sleep(0.1)
+            transport.urlopen(url + '/mailer', 'body=2').read()
+        finally:
+            transport.close()
+            server.shutdown()
+        
+        self.assertEqual(['/close', '/mailer'], server.paths)
+        self.assertEqual(2, server.connections)
+    
+    @unittest.skipIf(h2 is None, 'h2 is not installed')
+    def test_http2_multiplexing(self):
+        """Test that concurrent requests share one HTTP/2 connection."""
+        
+        # The server only answers once all requests are in flight, so this
+        # can only pass if they are multiplexed.
+        server = HTTP2StandIn(batch=5)
+        mimi = madmimi.MadMimi('test@test.com', '23890889df8909fs09s09',
+                transport=madmimi.HTTP2Transport(timeout=10))
+        mimi.base_url = mimi.secure_base_url = (
+                'http://127.0.0.1:%d/' % server.port)
+        results = []
+        
+        def poll(transaction_id):
+            results.append(mimi.message_status(transaction_id))
+        
+        threads = [threading.Thread(target=poll, args=(i,))
+                for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        mimi.close()
+        server.shutdown()
+        
+        self.assertEqual(5, len(results))
+        self.assertTrue(all(result.startswith('GET /mailers/status/')
+                for result in results))
+        self.assertEqual(1, server.connections)
+    
+    @unittest.skipIf(h2 is None, 'h2 is not installed')
+    def test_http2_bodies(self):
+        """Test HTTP/2 requests with bodies larger than the window."""
+        
+        server = HTTP2StandIn()
+        transport = madmimi.HTTP2Transport(timeout=10)
+        url = 'http://127.0.0.1:%d' % server.port
+        body = 'x' * 200000
+        try:
+            response = transport.request('POST', url + '/mailer',
+                    StringIO(body))
+            self.assertEqual('POST /mailer ', response.read(13))
+            self.assertEqual(body, response.read())
+            self.assertRaises(HTTPError, transport.request, 'GET',
+                    url + '/missing')
+        finally:
+            transport.close()
+            server.shutdown()
+    
+    @unittest.skipIf(h2 is None, 'h2 is not installed')
+    def test_http2_slow_reader(self):
+        """Test that an unread HTTP/2 body buffers at most one window."""
+        
+        server = HTTP2StandIn()
+        transport = madmimi.HTTP2Transport(timeout=10)
+        url = 'http://127.0.0.1:%d' % server.port
+        body = 'x' * 200000
+        try:
+            response = transport.request('POST', url + '/mailer',
+                    StringIO(body))
+            # Other requests keep the socket read while the body sits.
+            for i in range(3):
+                self.assertEqual('GET /mailer ',
+                        transport.request('GET', url + '/mailer').read())
+            buffered = sum(len(chunk) for chunk in response._chunks)
+            self.assertTrue(buffered <= 65535, buffered)
+            self.assertEqual('POST /mailer ' + body, response.read())
+        finally:
+            transport.close()
+            server.shutdown()
+    
+    @unittest.skipIf(h2 is None, 'h2 is not installed')
+    def test_http2_stuck_stream(self):
+        """Test that traffic on other streams doesn't stop a timeout."""
+        
+        server = HTTP2StandIn()
+        transport = madmimi.HTTP2Transport(timeout=1)
+        url = 'http://127.0.0.1:%d' % server.port
+        stop = threading.Event()
+        
+        def poll():
+            deadline = time.time() + 5
+            while not stop.is_set() and time.time() < deadline:
+                transport.request('GET', url + '/mailers/status/1').read()
+        
+        thread = threading.Thread(target=poll)
+        thread.start()
+        try:
+            started = time.time()
+            self.assertRaises(URLError, transport.request, 'GET',
+                    url + '/stuck')
+            elapsed = time.time() - started
+        finally:
+            stop.set()
+            thread.join()
+            transport.close()
+            server.shutdown()
+        
+        self.assertTrue(elapsed < 3, elapsed)
+        self.assertEqual(1, server.resets)
+    
+    @unittest.skipIf(h2 is None, 'h2 is not installed')
+    def test_http2_timeout_frees_stream(self):
+        """Test that a timed out request gives back its stream."""
+        
+        server = HTTP2StandIn(max_streams=1)
+        transport = madmimi.HTTP2Transport(timeout=1)
+        url = 'http://127.0.0.1:%d' % server.port
+        try:
+            self.assertRaises(URLError, transport.request, 'GET',
+                    url + '/stuck')
+            self.assertEqual('GET /mailer ',
+                    transport.request('GET', url + '/mailer').read())
+        finally:
+            transport.close()
+            server.shutdown()
+        
+        self.assertEqual(1, server.connections)
+        self.assertEqual(1, server.resets)
+    
+    @unittest.skipIf(h2 is None, 'h2 is not installed')
+    def test_http2_goaway(self):
+        """Test that a GOAWAY from the server doesn't break the transport."""
+        
+        server = HTTP2StandIn()
+        transport = madmimi.HTTP2Transport(timeout=5)
+        url = 'http://127.0.0.1:%d' % server.port
+        try:
+            # A response after the GOAWAY can't be read, but the error is
+            # a URLError and the next request gets a new connection.
+            self.assertRaises(URLError, transport.request, 'GET',
+                    url + '/goaway-before')
+            self.assertEqual('GET /mailer ',
+                    transport.request('GET', url + '/mailer').read())
+            self.assertEqual('GET /goaway-after ',
+                    transport.request('GET', url + '/goaway-after').read())
+            self.assertEqual('GET /mailer ',
+                    transport.request('GET', url + '/mailer').read())
+        finally:
+            transport.close()
+            server.shutdown()
+        
+        self.assertEqual(3, server.connections)
+    
+    @unittest.skipIf(h2 is None, 'h2 is not installed')
+    def test_close_after_fork(self):
+        """Test that closing in a forked child leaves the parent's
+        connection alone."""
+        
+        server = HTTP2StandIn()
+        mimi = madmimi.MadMimi('test@test.com', '23890889df8909fs09s09',
+                transport=madmimi.HTTP2Transport(timeout=5))
+        mimi.base_url = 'http://127.0.0.1:%d/' % server.port
+        try:
+            mimi.promotion_stats()
+            pid = os.fork()
+            if not pid:
+                try:
+                    mimi.close()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            
+            self.assertTrue(mimi.promotion_stats().startswith('GET '))
+        finally:
+            mimi.close()
+            server.shutdown()
+        
+        self.assertEqual(1, server.connections)
+    
+    @unittest.skipIf(h2 is None, 'h2 is not installed')
+    def test_http2_reset(self):
+        """Test that a reset transport opens a new connection."""
+        
+        server = HTTP2StandIn()
+        mimi = madmimi.MadMimi('test@test.com', '23890889df8909fs09s09',
+                transport='http2')
+        mimi.base_url = 'http://127.0.0.1:%d/' % server.port
+        
+        mimi.promotion_stats()
+        mimi._pid = -1
+        mimi.promotion_stats()
+        mimi.close()
+        server.shutdown()
+        
+        self.assertEqual(2, server.connections)
+    
+
+class HTTP11StandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A keep-alive HTTP/1.1 server echoing requests, for tests."""
+    
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            self.server.connections += 1
+        
+        def read_body(self):
+            if self.headers.get('Transfer-Encoding') != 'chunked':
+                return self.rfile.read(
+                        int(self.headers.get('Content-Length', 0)))
+            chunks = []
+            while True:
+                size = int(self.rfile.readline(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return ''.join(chunks)
+        
+        def respond(self):
+            body = '%s %s %s' % (self.command, self.path, self.read_body())
+            self.server.paths.append(self.path)
+            if self.path == '/slow':
+                time.sleep(1)
+            self.send_response(self.path == '/missing' and 404 or 200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            # Drop the connection without telling the client.
+            if self.path == '/close':
+                self.close_connection = 1
+        
+        do_GET = do_POST = respond
+        
+        def log_message(self, *args):
+            pass
+    
+    daemon_threads = True
+    
+    def handle_error(self, request, client_address):
+        pass
+    
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                self.Handler)
+        self.port = self.server_address[1]
+        self.connections = 0
+        self.paths = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class HTTP2StandIn(object):
+    """An HTTP/2 server (prior knowledge, no TLS) echoing requests.
+    
+    Responses are held back until batch requests have arrived on a
+    connection. Requests for /stuck are never answered. Requests for
+    /goaway-before and /goaway-after are answered and then the connection
+    is closed, with a GOAWAY sent before or after the response.
+    """
+    
+    def __init__(self, batch=1, max_streams=None):
+        self.batch = batch
+        self.max_streams = max_streams
+        self.connections = 0
+        self.resets = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.threads = []
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+    
+    def accept(self):
+        while True:
+            try:
+                client = self.sock.accept()[0]
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    
+    def shutdown(self):
+        """Stop accepting and wait for the clients to disconnect."""
+        self.sock.close()
+        for thread in self.threads:
+            thread.join(5)
+    
+    def serve(self, client):
+        conn = h2.connection.H2Connection(
+                config=h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        if self.max_streams is not None:
+            conn.update_settings({h2.settings.SettingCodes
+                    .MAX_CONCURRENT_STREAMS: self.max_streams})
+        client.sendall(conn.data_to_send())
+        requests = {}
+        finished = []
+        outgoing = {}
+        while True:
+            data = client.recv(65535)
+            if not data:
+                break
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    requests[event.stream_id] = (dict(event.headers), [])
+                elif isinstance(event, h2.events.DataReceived):
+                    requests[event.stream_id][1].append(event.data)
+                    conn.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    finished.append(event.stream_id)
+                elif isinstance(event, h2.events.StreamReset):
+                    self.resets += 1
+                    requests.pop(event.stream_id, None)
+                    outgoing.pop(event.stream_id, None)
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    client.close()
+                    return
+            if len(finished) >= self.batch:
+                for stream_id in finished:
+                    headers, chunks = requests.pop(stream_id)
+                    path = headers[':path']
+                    if path.startswith('/stuck'):
+                        continue
+                    body = '%s %s %s' % (headers[':method'],
+                            path.split('?')[0], ''.join(chunks))
+                    status = path.startswith('/missing') and '404' or '200'
+                    conn.send_headers(stream_id, [(':status', status),
+                            ('content-length', str(len(body)))])
+                    outgoing[stream_id] = body
+                    if path.startswith('/goaway'):
+                        self.go_away(client, conn, stream_id, outgoing,
+                                path.startswith('/goaway-before'))
+                        return
+                finished = []
+            self.send_bodies(conn, outgoing)
+            client.sendall(conn.data_to_send())
+    
+    def go_away(self, client, conn, stream_id, outgoing, before):
+        """Send the pending responses with a GOAWAY and hang up."""
+        self.send_bodies(conn, outgoing)
+        frame = hyperframe.frame.GoAwayFrame(0)
+        frame.last_stream_id = stream_id
+        frame.error_code = 0
+        if before:
+            client.sendall(frame.serialize() + conn.data_to_send())
+        else:
+            client.sendall(conn.data_to_send() + frame.serialize())
+        client.close()
+    
+    def send_bodies(self, conn, outgoing):
+        """Send as much of the response bodies as flow control allows."""
+        for stream_id, body in outgoing.items():
+            while body:
+                size = min(len(body), conn.max_outbound_frame_size,
+                        conn.local_flow_control_window(stream_id))
+                if not size:
+                    break
+                conn.send_data(stream_id, body[:size])
+                body = body[size:]
+            if body:
+                outgoing[stream_id] = body
+            else:
+                conn.end_stream(stream_id)
+                del outgoing[stream_id]
+    
 
 def generate_lists(audience_lists):
     """Helper for returning dynamic lists."""